@@ -34,19 +34,37 @@ Parameters:
     -r, --replace-with: [char] Replace invalid characters with this character. Default is '_'.
     -d, --directory: [/path/to/directory] The directory to sanitize.
     -o, --overwrite: Overwrite existing files on conflict.
+    -t, --state-file: [/path/to/state.json] Remember folders that are already clean and skip them on later runs
+                      as long as their content did not change. Lists the tree folder by folder instead of
+                      with a single deep listing, so unchanged folders cost no requests at all.
 
 Dependencies:
     webdav4: https://pypi.org/project/webdav4/
+    httpx[http2]: https://pypi.org/project/httpx/
     keyring: https://pypi.org/project/keyring/
 """
 
-import re
+from __future__ import annotations
+
 import argparse
+import atexit
 import logging
+import queue
+import threading
 import getpass
-import urllib.parse as urllib
+import json
+import os
+import httpx
 import keyring
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import PurePosixPath
+from typing import Iterator
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+from webdav4.client import HTTPError
 from webdav4.fsspec import WebdavFileSystem, ResourceAlreadyExists
 
 __author__ = "Manuel J. Mehltretter"
@@ -65,31 +83,201 @@ WEBDAV_USERNAME = 'username'
 ### No changes needed below this line ###
 
 # Global variables
-keyring_system = 'f{WEBDAV_ADDRESS}-filename-sanitizer'
+KEYRING_SYSTEM = f'{WEBDAV_ADDRESS}-filename-sanitizer'
 replace_with = '_'
 safe_mode = False
 overwrite = False
+max_workers = 8
+state_file: str | None = None
+clean_folders: dict[str, str] = {}
+_unsaved_changes = 0
 logger: logging.Logger
 fs: WebdavFileSystem
 
+# Precompiled lookups used by sanitize_filename
+_INVALID_CHARACTERS = '\\/:*?"<>|'
+_INVALID_SET = frozenset(_INVALID_CHARACTERS)
+_INVALID_TRANS = str.maketrans(dict.fromkeys(_INVALID_CHARACTERS, replace_with))
+_RESERVED = frozenset({'CON', 'PRN', 'AUX', 'NUL', 'COM¹', 'COM²', 'COM³', 'LPT¹', 'LPT²', 'LPT³',
+                       *(f'COM{i}' for i in range(1, 10)), *(f'LPT{i}' for i in range(1, 10))})
+
+# Only request the resource type and etag when listing, nothing else is needed
+_PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                  '<d:propfind xmlns:d="DAV:"><d:prop><d:resourcetype/><d:getetag/></d:prop></d:propfind>')
+
+# One lock per parent folder, serializes conflict handling between worker threads
+_conflict_locks: dict[PurePosixPath, threading.Lock] = {}
+
+
+def connect(password: str) -> WebdavFileSystem:
+    """Create the WebDAV connection used for all requests.
+
+    The underlying httpx client keeps its connections alive and uses HTTP/2, so all PROPFIND and MOVE requests
+    of a run (including those of parallel workers) share as few TCP/TLS connections as possible.
+
+    Parameters
+    ----------
+    password : str
+        The password to authenticate with.
+
+    Returns
+    -------
+    WebdavFileSystem
+        The connected file system.
+    """
+
+    return WebdavFileSystem(WEBDAV_ADDRESS,
+                            auth=(WEBDAV_USERNAME, password),
+                            limits=httpx.Limits(max_keepalive_connections=16, max_connections=16,
+                                                keepalive_expiry=60.0),
+                            http2=True)
+
 
 def init():
     """Initialize the script by storing the password in the OS credential store and performing a connection test."""
-    
-    keyring.set_password(keyring_system, WEBDAV_USERNAME, getpass.getpass('Please enter your webdav password: '))
+
+    global fs
+    password = getpass.getpass('Please enter your webdav password: ')
+    keyring.set_password(KEYRING_SYSTEM, WEBDAV_USERNAME, password)
 
     # Perform a connection test
     try:
-        fs = WebdavFileSystem(WEBDAV_ADDRESS, 
-                              auth=(WEBDAV_USERNAME, keyring.get_password(keyring_system, WEBDAV_USERNAME)))
+        fs = connect(password)
         fs.ls('/')
         logger.info('Connection successful! - You are ready to go.')
     except Exception as e:
-        logger.error(f'Connection failed: {e}')
+        logger.error('Connection failed: %s', e)
         exit(1)
 
 
-def sanitize_filename(path: PurePosixPath) -> PurePosixPath:
+def load_state():
+    """Load the folders that were found clean in a previous run, together with their etags, from the state file."""
+
+    global clean_folders
+    if state_file and os.path.exists(state_file):
+        with open(state_file, encoding='utf-8') as f:
+            clean_folders = json.load(f)
+        logger.info('Loaded %d known clean folders from %s', len(clean_folders), state_file)
+
+
+def save_state():
+    """Write the folders known to be clean to the state file.
+
+    The file is replaced atomically, so an interrupted run never leaves a broken state file behind.
+    """
+
+    global _unsaved_changes
+    if not state_file:
+        return
+    with open(f'{state_file}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(clean_folders, f, indent=0, sort_keys=True)
+    os.replace(f'{state_file}.tmp', state_file)
+    _unsaved_changes = 0
+
+
+def _state_key(path: PurePosixPath) -> str:
+    """Key of a folder in the state file, its path relative to WEBDAV_ADDRESS without surrounding slashes."""
+
+    key = str(path).strip('/')
+    return '' if key == '.' else key
+
+
+def is_known_clean(path: PurePosixPath, etag: str | None) -> bool:
+    """Check whether a folder and its whole content were clean in a previous run and did not change since.
+
+    Nextcloud changes the etag of a folder whenever anything below it changes,
+    so a matching etag means nothing new was uploaded into the folder in the meantime.
+
+    Parameters
+    ----------
+    path : PurePosixPath
+        The path to the folder, relative to WEBDAV_ADDRESS.
+    etag : str | None
+        The current etag of the folder.
+
+    Returns
+    -------
+    bool
+        True if the folder can be skipped.
+    """
+
+    return etag is not None and clean_folders.get(_state_key(path)) == etag
+
+
+def mark_clean(path: PurePosixPath, etag: str | None):
+    """Remember that a folder and its whole content did not need any renames.
+
+    The state file is flushed after every 100 new or changed entries, so an interrupted run keeps most of
+    its progress. Folders without a known etag are not remembered, because a later change could not be detected.
+
+    Parameters
+    ----------
+    path : PurePosixPath
+        The path to the folder, relative to WEBDAV_ADDRESS.
+    etag : str | None
+        The etag of the folder when it was listed.
+    """
+
+    global _unsaved_changes
+    key = _state_key(path)
+    if etag is None or clean_folders.get(key) == etag:
+        return
+    clean_folders[key] = etag
+    _unsaved_changes += 1
+    if _unsaved_changes >= 100:
+        save_state()
+
+
+def prune_state(path: PurePosixPath, confirmed: set[str], skipped: set[str]):
+    """Forget folders below a walked directory that were not confirmed clean during this run.
+
+    These folders became dirty, were renamed or were deleted since they were remembered.
+    Folders below a skipped folder were not visited, but are still covered by its unchanged etag.
+
+    Parameters
+    ----------
+    path : PurePosixPath
+        The path to the directory that was walked.
+    confirmed : set[str]
+        State keys of the folders remembered as clean during this run.
+    skipped : set[str]
+        State keys of the folders skipped as known clean during this run.
+    """
+
+    global _unsaved_changes
+    root = _state_key(path)
+    for key in list(clean_folders):
+        if key in confirmed or key in skipped or (root and key != root and not key.startswith(f'{root}/')):
+            continue
+        if any(_state_key(parent) in skipped for parent in PurePosixPath(key).parents):
+            continue
+        del clean_folders[key]
+        _unsaved_changes += 1
+
+
+def quote_path(path: PurePosixPath | str) -> str:
+    """Percent-encode a path before it is handed to webdav4.
+
+    webdav4 puts paths into the request url as they are. Unencoded, '?' and '#' make the url invalid,
+    and a literal '%' would be read as an escape sequence. Every request goes through this function,
+    so each path is encoded exactly once.
+
+    Parameters
+    ----------
+    path : PurePosixPath | str
+        The path relative to WEBDAV_ADDRESS.
+
+    Returns
+    -------
+    str
+        The percent-encoded path.
+    """
+
+    return quote(str(path))
+
+
+def sanitize_filename(path: PurePosixPath,
+                      _invalid: frozenset = _INVALID_SET, _reserved: frozenset = _RESERVED) -> PurePosixPath:
     """Sanitize a filename to comply with Windows naming conventions.
 
     This function first replaces or removes invalid characters.
@@ -107,24 +295,30 @@ def sanitize_filename(path: PurePosixPath) -> PurePosixPath:
         The sanitized path.
     """
 
-    windows_reserved_names = ['CON', 'PRN', 'AUX', 'NUL', 'COM¹', 'COM²', 'COM³', 'LPT¹', 'LPT²', 'LPT³',
-                          'COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 
-                          'LPT1', 'LPT2', 'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9']
-    invalid_characters = r'[\\/:*?"<>|]'
-
+    # _invalid and _reserved are bound as defaults, so they are fast local lookups in this hot function.
+    # _INVALID_TRANS stays global, because it is rebuilt when --replace-with is set.
+    # Work on the name only and build a new path object at most once
+    name = path.name
     # Replace invalid characters
-    path = path.with_name(re.sub(invalid_characters, replace_with, path.name))
-    # Check for reserved names on Windows
-    if path.name.upper() in windows_reserved_names:
-        path = path.with_name('_reserved')
-    return path
+    new_name = name if _invalid.isdisjoint(name) else name.translate(_INVALID_TRANS)
+    # Remove trailing spaces and periods. rstrip returns the same object if there is nothing to strip.
+    new_name = new_name.rstrip(' .') or '_'
+    # Check for reserved names on Windows. Windows ignores everything after the first period,
+    # so 'NUL.txt' and 'NUL.tar.gz' are reserved as well. The extension is kept.
+    # All reserved names are 3 or 4 characters long, so most names are ruled out without uppercasing them.
+    stem, dot, extension = new_name.partition('.')
+    if 3 <= len(stem) <= 4 and stem.upper() in _reserved:
+        new_name = f'_reserved{dot}{extension}'
+    # Most names are already valid, return the original path object for them
+    return path if new_name is name else path.parent / new_name
 
 
 def process_item(path: PurePosixPath) -> PurePosixPath:
     """Process a single file or folder.
 
     Calls the sanitize_filename function. If the filename is changed, the file is renamed.
-    This script tries to be safe by default. Conflicts are resolved by appending '_1' to the filename.
+    This script tries to be safe by default. Conflicts are resolved by appending '_1' to the filename,
+    or '_2', '_3', ... if that name is taken as well.
     Files will only be overwritten if the overwrite flag is set.
     
     Parameters
@@ -142,44 +336,112 @@ def process_item(path: PurePosixPath) -> PurePosixPath:
     new_path = sanitize_filename(path)
     if new_path != path:
         if safe_mode:
-            logger.info(f'''Would rename: '{path}') 
-                        to '{new_path}'
-                        ''')
+            logger.info("Would rename: '%s' to '%s'", path, new_path)
             return path
         else:
             try:
-                fs.mv(urllib.quote(str(path)), urllib.quote(str(new_path)), recursive=True)
-                logger.info(f'''Renamed: '{path}'
-                            to '{new_path}'
-                            ''')
+                fs.client.move(quote_path(path), quote_path(new_path))
+                logger.info("Renamed: '%s' to '%s'", path, new_path)
             except ResourceAlreadyExists as e:
-                if not overwrite:
-                    logger.warning(f'''Conflict: '{new_path}' already exists. 
-                                    Appended '_1' to the filename.
-                                    ''')
-                    new_path = new_path.with_name(new_path.name + '_1')
-                    fs.mv(urllib.quote(str(path)), urllib.quote(f'{new_path}_1'), recursive=True)
-                else:
-                    logger.warning(f'''Conflict: Overwriting {new_path}
-                    ''')
-                    fs.rm(urllib.quote(str(new_path)))
-                    fs.mv(urllib.quote(str(path)), urllib.quote(str(new_path)), recursive=True)
+                # Errors raised in here are not caught by the except clause below. They must not escape,
+                # or they would abort the whole level in process_deep.
+                with _conflict_locks.setdefault(new_path.parent, threading.Lock()):
+                    try:
+                        if not overwrite:
+                            counter = 1
+                            while True:
+                                candidate = f'{new_path}_{counter}'
+                                try:
+                                    fs.client.move(quote_path(path), quote_path(candidate))
+                                    break
+                                except ResourceAlreadyExists:
+                                    counter += 1
+                            logger.warning("Conflict: '%s' already exists. Appended '_%d' to the filename.",
+                                           new_path, counter)
+                            new_path = PurePosixPath(candidate)
+                        else:
+                            logger.warning("Conflict: Overwriting '%s'", new_path)
+                            # Single MOVE with 'Overwrite: T' instead of DELETE followed by MOVE
+                            fs.client.move(quote_path(path), quote_path(new_path), overwrite=True)
+                    except Exception as e:
+                        logger.error("Could not rename '%s': %s", path, e)
             except Exception as e:
-                logger.error(f'''Could not rename '{path}': 
-                             {e}''')
+                logger.error("Could not rename '%s': %s", path, e)
     else:
-        logger.debug(f'Skipped: {path}')
+        logger.debug('Skipped: %s', path)
     
     return new_path
 
 
+def list_folder(path: PurePosixPath) -> Iterator[tuple[PurePosixPath, bool, str | None]]:
+    """List the content of a single folder while the PROPFIND response is still being received.
+
+    fs.ls buffers the whole response and builds a dict per entry before returning.
+    This generator feeds the response body into an incremental XML parser instead and yields every
+    entry as soon as it has been parsed, so large folders are processed while they are still being listed.
+    Parsed entries are removed from the document root again, so memory use depends on the size of
+    the received chunks instead of the size of the folder.
+    Opening the response is retried with the webdav4 client's retry policy, like fs.ls would.
+    Errors while the body is streamed are not retried, as entries have already been processed by then.
+
+    Parameters
+    ----------
+    path : PurePosixPath
+        The path to the folder to be listed.
+
+    Yields
+    ------
+    tuple[PurePosixPath, bool, str | None]
+        The path of each item in the folder, whether it is a folder itself and its etag.
+    """
+
+    base = unquote(fs.client.base_url.path).strip('/')
+    folder = str(path).strip('/')
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    request = fs.client.http.build_request('PROPFIND', fs.client.join_url(quote_path(path)),
+                                           headers={'Depth': '1', 'Content-Type': 'application/xml'},
+                                           content=_PROPFIND_BODY)
+
+    def open_listing() -> httpx.Response:
+        # Raise webdav4's HTTPError, so the client's retry policy applies just like for fs.ls
+        response = fs.client.http.send(request, stream=True)
+        if response.is_error:
+            response.close()
+            raise HTTPError(response)
+        return response
+
+    response = fs.client.with_retry(open_listing)
+    try:
+        for chunk in response.iter_bytes():
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if root is None:
+                    # The first start event belongs to <d:multistatus>, all responses are its children
+                    root = element
+                if event != 'end' or element.tag != '{DAV:}response':
+                    continue
+                item = unquote(element.findtext('{DAV:}href')).strip('/')
+                item = item[len(base):].strip('/') if item.startswith(base) else item
+                is_directory = element.find('.//{DAV:}resourcetype/{DAV:}collection') is not None
+                etag = element.findtext('.//{DAV:}getetag') or None
+                root.remove(element)
+                if item != folder:
+                    yield PurePosixPath(item), is_directory, etag
+    finally:
+        response.close()
+
+
 def process_recursive(path: PurePosixPath):
-    """Process all files and folders in a directory recursively.
-    
-    webdav4 does not support recursive listing. 
-    webdav4 would support recursive listing with fs.glob("/**"), but can't be used here.
-    The reason is, that the folder name must be renamed, before we traverse the tree further.
-    Therefore, this function recursively traverses the directory tree and calls process_item on each item.
+    """Process all files and folders in a directory recursively, listing one folder at a time.
+
+    This is the fallback walker for servers that refuse or truncate the deep listing of process_deep,
+    and the walker used with a state file, because it can skip clean folders without listing them.
+    Each folder is renamed before its content is listed, so the listing already uses the new path.
+    Folders still to be listed are kept on an explicit stack instead of recursing, so deep trees
+    do not hit Python's recursion limit. A folder that can't be listed is logged and skipped.
+    If a state file is used, folders known to be clean with an unchanged etag are skipped without listing them,
+    and folders whose whole content needed no renames are remembered as clean once they are finished.
     
     Parameters
     ----------
@@ -187,17 +449,106 @@ def process_recursive(path: PurePosixPath):
         The path to the directory to be traversed.
     """
 
+    stack = deque([path])
+    parent_of: dict[PurePosixPath, PurePosixPath | None] = {path: None}
+    etag_of: dict[PurePosixPath, str | None] = {}
+    open_subfolders: dict[PurePosixPath, int] = {}
+    dirty: set[PurePosixPath] = set()
+    confirmed: set[str] = set()
+    skipped: set[str] = set()
+    while stack:
+        current = stack.pop()
+        open_subfolders[current] = 0
+        if is_known_clean(current, etag_of.get(current)):
+            logger.debug('Skipped known clean folder: %s', current)
+            skipped.add(_state_key(current))
+        else:
+            try:
+                for item_path, is_directory, etag in list_folder(current):
+                    if state_file and sanitize_filename(item_path) is not item_path:
+                        dirty.add(current)
+                    if is_directory:
+                        new_path = process_item(item_path)
+                        parent_of[new_path] = current
+                        etag_of[new_path] = etag
+                        open_subfolders[current] += 1
+                        stack.append(new_path)
+                    else:
+                        process_item(item_path)
+            except Exception as e:
+                logger.error("Could not list '%s': %s", current, e)
+                dirty.add(current)
+
+        # Walk up the tree as long as folders have no unfinished subfolders left
+        folder = current
+        while folder is not None and open_subfolders[folder] == 0:
+            del open_subfolders[folder]
+            parent = parent_of.pop(folder)
+            etag = etag_of.pop(folder, None)
+            if folder in dirty:
+                if parent is not None:
+                    dirty.add(parent)
+            elif state_file:
+                mark_clean(folder, etag)
+                confirmed.add(_state_key(folder))
+            if parent is not None:
+                open_subfolders[parent] -= 1
+            folder = parent
+
+    if state_file:
+        prune_state(path, confirmed, skipped)
+
+
+def process_deep(path: PurePosixPath):
+    """Process all files and folders in a directory using a single deep listing.
+
+    The whole tree is fetched with one PROPFIND request (Depth: infinity) instead of one request per folder.
+    Items are processed deepest first, so renaming an item never changes the path of an item still waiting
+    in the queue. Its parent folder is only renamed after all of its content has been handled.
+    All items on the same level are independent of each other and are renamed in parallel worker threads,
+    sharing the connection pool of the global WebdavFileSystem.
+    Falls back to process_recursive if the server refuses the deep listing, or silently answers it with
+    a single level only, as sabre/dav does when Depth: infinity is disabled in Nextcloud.
+    The state file is not used here, see process_recursive.
+
+    Parameters
+    ----------
+    path : PurePosixPath
+        The path to the directory to be traversed.
+    """
+
     try:
-        for item in fs.ls(urllib.quote(str(path)), detail=True):
-            item_path = PurePosixPath(item['name'])
-            if item['type'] == 'file':
-                process_item(item_path)
-            elif item['type'] == 'directory':
-                new_folder_name = process_item(item_path)
-                process_recursive(new_folder_name)
+        # Without a body the server answers with all properties of every item in the tree
+        response = fs.client.propfind(quote_path(path), data=_PROPFIND_BODY,
+                                      headers={'Depth': 'infinity', 'Content-Type': 'application/xml'})
     except Exception as e:
-        logger.error(f'''Could not list '{path}' 
-                     {e}''')
+        logger.warning("Deep listing of '%s' failed, falling back to per-folder listing: %s", path, e)
+        process_recursive(path)
+        return
+
+    # Responses carry absolute hrefs, webdav4 expects paths relative to the base url
+    root = str(path).strip('/')
+    relative = {item: PurePosixPath(item.path_relative_to(fs.client.base_url).strip('/'))
+                for item in response.responses.values()}
+    is_directory = {item_path: item.properties.collection for item, item_path in relative.items()}
+    items = [item for item in is_directory if item != PurePosixPath(root)]
+
+    # Subfolders without anything listed below them look exactly like a listing cut off after one level.
+    # Walking folder by folder is correct in both cases, it just costs a few more requests for empty folders.
+    root_depth = len(PurePosixPath(root).parts)
+    if any(is_directory[item] for item in items) and all(len(item.parts) == root_depth + 1 for item in items):
+        logger.warning("Deep listing of '%s' returned a single level only, falling back to per-folder listing",
+                       path)
+        process_recursive(path)
+        return
+    def depth(item: PurePosixPath) -> int:
+        return len(item.parts)
+
+    items.sort(key=depth, reverse=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _, level in groupby(items, key=depth):
+            # Wait for the whole level before renaming any of the parent folders
+            list(executor.map(process_item, level))
 
 
 if __name__ == '__main__':
@@ -221,6 +572,7 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--replace-with', type=str)
     parser.add_argument('-d', '--directory', type=str)
     parser.add_argument('-o', '--overwrite', action='store_true')
+    parser.add_argument('-t', '--state-file', type=str)
     args = parser.parse_args()
 
     # Process command line arguments
@@ -229,22 +581,43 @@ if __name__ == '__main__':
     if args.logfile:
         file_handler = logging.FileHandler(args.logfile, mode='a')
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        # Write the log file from a background thread, so renames never wait for disk I/O
+        log_queue = queue.Queue(-1)
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
     if args.verbose:
         logger.setLevel(logging.DEBUG)
     if args.safe_mode:
         safe_mode = True
     if args.replace_with:
         replace_with = args.replace_with
+        _INVALID_TRANS = str.maketrans(dict.fromkeys(_INVALID_CHARACTERS, replace_with))
     if args.overwrite:
         overwrite = True
+    if args.state_file:
+        state_file = args.state_file
+        load_state()
     if not args.directory:
         logger.info('No directory provided. Ending script...')
         exit(0)
     
     # Do stuff
-    fs = WebdavFileSystem(WEBDAV_ADDRESS, 
-                          auth=(WEBDAV_USERNAME, keyring.get_password(keyring_system, WEBDAV_USERNAME)))
+    if not args.init:
+        password = keyring.get_password(KEYRING_SYSTEM, WEBDAV_USERNAME)
+        if password is None:
+            # Also happens after upgrading from older versions, which stored the password under a different key
+            logger.error('No password stored for %s. Please run the script with -i first.', WEBDAV_USERNAME)
+            exit(1)
+        fs = connect(password)
     path = PurePosixPath(args.directory.strip())
-    logger.info(f'Starting to sanitize filenames in {str(path)}')
-    process_recursive(path)
+    logger.info('Starting to sanitize filenames in %s', path)
+    try:
+        # The deep listing always fetches the whole tree, only the per-folder walker can skip clean folders
+        if state_file:
+            process_recursive(path)
+        else:
+            process_deep(path)
+    finally:
+        save_state()
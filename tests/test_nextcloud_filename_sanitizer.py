@@ -0,0 +1,277 @@
+"""Tests for nextcloud_filename_sanitizer against an in-memory WebDAV server.
+
+The server is plugged into httpx with a MockTransport and mimics the parts of Nextcloud the script relies on:
+hrefs are absolute and percent-encoded, and the WebDAV root lives below a base path.
+
+Run from the repository root with:
+    $ python -m pytest
+"""
+
+import hashlib
+import logging
+from pathlib import PurePosixPath
+from urllib.parse import quote
+
+import httpx
+import pytest
+from webdav4.client import Client
+from webdav4.fsspec import WebdavFileSystem
+
+import nextcloud_filename_sanitizer as sanitizer
+
+BASE_URL = 'https://cloud.example.com/remote.php/dav/files/username/'
+BASE_PATH = '/remote.php/dav/files/username'
+
+
+class FakeNextcloud:
+    """Minimal WebDAV server keeping a tree of paths relative to BASE_PATH in memory."""
+
+    def __init__(self, files=(), folders=(), depth_infinity=True):
+        self.tree = {'': True}
+        self.locked = set()
+        self.depth_infinity = depth_infinity
+        self.requests = []
+        self.propfind_bodies = []
+        self.failures = []
+        for folder in folders:
+            self.tree[folder] = True
+        for file in files:
+            self.tree[file] = False
+
+    def etag(self, path):
+        content = sorted(item for item in self.tree if item.startswith(f'{path}/') or item == path)
+        return hashlib.md5('\n'.join(content).encode()).hexdigest()
+
+    def relative(self, url_path):
+        return url_path[len(BASE_PATH):].strip('/')
+
+    def subtree(self, path):
+        return [item for item in self.tree if item == path or item.startswith(f'{path}/') or not path]
+
+    def propfind(self, path, depth):
+        if path not in self.tree:
+            return httpx.Response(404)
+        if depth == 'infinity' and not self.depth_infinity:
+            # sabre/dav silently answers with Depth: 1 if infinity is disabled
+            depth = '1'
+        entries = [path]
+        if depth != '0':
+            entries += [item for item in self.subtree(path) if item != path and
+                        (depth == 'infinity' or item.rpartition('/')[0] == path)]
+        responses = []
+        for entry in entries:
+            is_dir = self.tree[entry]
+            href = quote(f'{BASE_PATH}/{entry}'.rstrip('/') + ('/' if is_dir else ''))
+            resourcetype = '<d:collection/>' if is_dir else ''
+            responses.append(f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>'
+                             f'<d:resourcetype>{resourcetype}</d:resourcetype>'
+                             f'<d:getetag>"{self.etag(entry)}"</d:getetag>'
+                             f'</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+        body = f'<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{"".join(responses)}</d:multistatus>'
+        return httpx.Response(207, content=body.encode(), headers={'Content-Type': 'application/xml'})
+
+    def transfer(self, path, request, keep_source):
+        destination = self.relative(httpx.URL(request.headers['Destination']).path)
+        if path not in self.tree:
+            return httpx.Response(404)
+        if path in self.locked or destination in self.locked:
+            return httpx.Response(423)
+        if destination.rpartition('/')[0] not in self.tree:
+            return httpx.Response(409)
+        if destination in self.tree:
+            if request.headers.get('Overwrite') == 'F':
+                return httpx.Response(412)
+            for item in self.subtree(destination):
+                del self.tree[item]
+        for item in self.subtree(path):
+            self.tree[destination + item[len(path):]] = self.tree[item]
+            if not keep_source:
+                del self.tree[item]
+        return httpx.Response(201)
+
+    def __call__(self, request):
+        path = self.relative(request.url.path)
+        self.requests.append((request.method, path))
+        if self.failures:
+            return httpx.Response(self.failures.pop())
+        if request.content and request.headers.get('Content-Type') != 'application/xml':
+            return httpx.Response(415)
+        if request.method == 'PROPFIND':
+            self.propfind_bodies.append((request.headers.get('Depth'), request.headers.get('Content-Type'),
+                                         request.content))
+            return self.propfind(path, request.headers.get('Depth', 'infinity'))
+        if request.method in ('MOVE', 'COPY'):
+            return self.transfer(path, request, keep_source=request.method == 'COPY')
+        if request.method == 'DELETE':
+            if path not in self.tree:
+                return httpx.Response(404)
+            for item in self.subtree(path):
+                del self.tree[item]
+            return httpx.Response(204)
+        return httpx.Response(200)
+
+    def paths(self):
+        return {item for item in self.tree if item}
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """Point the script at a FakeNextcloud and reset its global settings."""
+
+    monkeypatch.setattr(sanitizer, 'logger', logging.getLogger('test'), raising=False)
+    monkeypatch.setattr(sanitizer, 'safe_mode', False)
+    monkeypatch.setattr(sanitizer, 'overwrite', False)
+
+    def _connect(server, retry=False):
+        http = httpx.Client(base_url=BASE_URL, transport=httpx.MockTransport(server))
+        client = Client(BASE_URL, http_client=http, retry=retry)
+        monkeypatch.setattr(sanitizer, 'fs', WebdavFileSystem(BASE_URL, client=client), raising=False)
+        return server
+
+    return _connect
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('report.docx', 'report.docx'),
+    ('a:b*c.txt', 'a_b_c.txt'),
+    ('trailing. .', 'trailing'),
+    ('con', '_reserved'),
+    ('NUL.tar.gz', '_reserved.tar.gz'),
+    ('console.txt', 'console.txt'),
+])
+def test_sanitize_filename(name, expected):
+    assert sanitizer.sanitize_filename(PurePosixPath('folder', name)) == PurePosixPath('folder', expected)
+
+
+def test_sanitize_filename_returns_valid_path_unchanged():
+    path = PurePosixPath('folder/report.docx')
+    assert sanitizer.sanitize_filename(path) is path
+
+
+def test_process_deep_renames_relative_to_base_path(connect):
+    server = connect(FakeNextcloud(folders=['top', 'top/sub:dir', 'top/clean'],
+                                   files=['top/a:b.txt', 'top/sub:dir/c:d.txt', 'top/clean/ok.txt']))
+
+    sanitizer.process_deep(PurePosixPath('/top'))
+
+    assert server.paths() == {'top', 'top/a_b.txt', 'top/sub_dir', 'top/sub_dir/c_d.txt',
+                              'top/clean', 'top/clean/ok.txt'}
+
+
+def test_process_deep_requests_only_needed_properties(connect):
+    server = connect(FakeNextcloud(folders=['top', 'top/sub'], files=['top/sub/ok.txt']))
+
+    sanitizer.process_deep(PurePosixPath('/top'))
+
+    depth, content_type, body = server.propfind_bodies[0]
+    assert (depth, content_type) == ('infinity', 'application/xml')
+    assert b'<d:resourcetype/><d:getetag/>' in body and b'allprop' not in body
+
+
+def test_process_deep_falls_back_when_depth_infinity_is_answered_with_one_level(connect):
+    server = connect(FakeNextcloud(folders=['top', 'top/sub:dir', 'top/sub:dir/deeper'],
+                                   files=['top/sub:dir/deeper/e:f.txt'], depth_infinity=False))
+
+    sanitizer.process_deep(PurePosixPath('/top'))
+
+    assert server.paths() == {'top', 'top/sub_dir', 'top/sub_dir/deeper', 'top/sub_dir/deeper/e_f.txt'}
+
+
+def test_process_deep_continues_after_failed_conflict_rename(connect):
+    server = connect(FakeNextcloud(folders=['top', 'top/sub:dir'],
+                                   files=['top/sub:dir/a:b.txt', 'top/sub:dir/a_b.txt', 'top/x:y.txt']))
+    server.locked.add('top/sub:dir/a_b.txt_1')
+
+    sanitizer.process_deep(PurePosixPath('/top'))
+
+    assert server.paths() == {'top', 'top/sub_dir', 'top/sub_dir/a:b.txt', 'top/sub_dir/a_b.txt', 'top/x_y.txt'}
+
+
+def test_process_item_appends_counter_on_conflict(connect):
+    server = connect(FakeNextcloud(folders=['top'], files=['top/a:b.txt', 'top/a_b.txt', 'top/a_b.txt_1']))
+
+    assert sanitizer.process_item(PurePosixPath('top/a:b.txt')) == PurePosixPath('top/a_b.txt_2')
+    assert server.paths() == {'top', 'top/a_b.txt', 'top/a_b.txt_1', 'top/a_b.txt_2'}
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('a?b.txt', 'a_b.txt'),
+    ('p#q:r.txt', 'p#q_r.txt'),
+    ('x%20y:z.txt', 'x%20y_z.txt'),
+    ('with space*.txt', 'with space_.txt'),
+])
+@pytest.mark.parametrize('depth_infinity', [True, False])
+def test_process_deep_encodes_special_characters(connect, name, expected, depth_infinity):
+    server = connect(FakeNextcloud(folders=['top', 'top/d?r', 'top/d?r/sub'],
+                                   files=[f'top/d?r/sub/{name}'], depth_infinity=depth_infinity))
+
+    sanitizer.process_deep(PurePosixPath('/top'))
+
+    assert server.paths() == {'top', 'top/d_r', 'top/d_r/sub', f'top/d_r/sub/{expected}'}
+
+
+def test_state_file_skips_unchanged_clean_folders_only(connect, monkeypatch, tmp_path):
+    server = connect(FakeNextcloud(folders=['top', 'top/clean', 'top/clean/deeper', 'top/bad:dir'],
+                                   files=['top/clean/deeper/ok.txt', 'top/bad:dir/ok.txt']))
+    monkeypatch.setattr(sanitizer, 'state_file', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(sanitizer, 'clean_folders', {})
+
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    sanitizer.save_state()
+    assert {'top/clean', 'top/clean/deeper'} <= set(sanitizer.clean_folders)
+
+    # Unchanged folders are not listed again
+    server.requests.clear()
+    sanitizer.load_state()
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert ('PROPFIND', 'top/clean') not in server.requests
+
+    # New content changes the etag, so the folder is sanitized again
+    server.tree['top/clean/deeper/new:file.txt'] = False
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert 'top/clean/deeper/new_file.txt' in server.paths()
+    assert 'top/clean/deeper/new:file.txt' not in server.paths()
+
+
+def test_state_file_is_not_rewritten_for_unchanged_entries(connect, monkeypatch, tmp_path):
+    folders = ['top'] + [f'top/f{i}' for i in range(200)]
+    connect(FakeNextcloud(folders=folders, files=[f'{folder}/ok.txt' for folder in folders[1:]]))
+    monkeypatch.setattr(sanitizer, 'state_file', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(sanitizer, 'clean_folders', {})
+    saves = []
+    save_state = sanitizer.save_state
+    monkeypatch.setattr(sanitizer, 'save_state', lambda: saves.append(1) or save_state())
+
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert len(saves) == 2
+
+    saves.clear()
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert saves == []
+
+
+def test_state_file_forgets_dirty_and_deleted_folders(connect, monkeypatch, tmp_path):
+    server = connect(FakeNextcloud(folders=['top', 'top/a', 'top/b', 'top/b/c'], files=['top/a/ok.txt']))
+    monkeypatch.setattr(sanitizer, 'state_file', str(tmp_path / 'state.json'))
+    monkeypatch.setattr(sanitizer, 'clean_folders', {})
+    monkeypatch.setattr(sanitizer, 'safe_mode', True)
+
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert {'top/a', 'top/b', 'top/b/c'} <= set(sanitizer.clean_folders)
+
+    server.tree['top/a/bad:name.txt'] = False
+    for item in server.subtree('top/b'):
+        del server.tree[item]
+    sanitizer.process_recursive(PurePosixPath('/top'))
+    assert not {'top/a', 'top/b', 'top/b/c'} & set(sanitizer.clean_folders)
+
+
+def test_list_folder_retries_transient_errors(connect, monkeypatch):
+    monkeypatch.setattr('webdav4.retry.BACKOFF', 0)
+    server = connect(FakeNextcloud(folders=['top', 'top/sub'], files=['top/a:b.txt']), retry=True)
+    server.failures.append(503)
+
+    assert sorted(sanitizer.list_folder(PurePosixPath('top'))) == [
+        (PurePosixPath('top/a:b.txt'), False, f'"{server.etag("top/a:b.txt")}"'),
+        (PurePosixPath('top/sub'), True, f'"{server.etag("top/sub")}"'),
+    ]